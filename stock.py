@@ -1,104 +1,184 @@
 import streamlit as st
+import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
+import functools
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import chain
+from pathlib import Path
 from zoneinfo import ZoneInfo
 from chinese_calendar import is_workday, is_holiday
 import pywencai
-
-def quick_select(arr, k):
-    if not arr or k <= 0 or k > len(arr):
-        return 0
-    
-    def partition(left, right):
-        pivot = arr[right]
-        i = left - 1
-        
-        for j in range(left, right):
-            if arr[j] >= pivot:  # 使用 >= 来实现降序排列
-                i += 1
-                arr[i], arr[j] = arr[j], arr[i]
-        
-        arr[i + 1], arr[right] = arr[right], arr[i + 1]
-        return i + 1
-    
-    def select(left, right, k):
-        if left == right:
-            return arr[left]
-        
-        pivot_idx = partition(left, right)
-        rank = pivot_idx - left + 1
-        
-        if rank == k:
-            return arr[pivot_idx]
-        elif rank > k:
-            return select(left, pivot_idx - 1, k)
-        else:
-            return select(pivot_idx + 1, right, k - rank)
-    
-    return select(0, len(arr) - 1, k)
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 def top_k_elements(series, k):
     if series.empty or k <= 0 or k > len(series):
         return 0
     
-    # 将 Series 转换为列表并使用快速选择算法
-    values = series.tolist()
-    return quick_select(values, k)
+    # 使用 numpy 的 partition 在 C 层面选出第 k 大的元素
+    values = series.to_numpy(dtype=np.int64)
+    return int(np.partition(values, -k)[-k])
 
 
-def safe_float(value):
-    """Safely convert a value to float, returning 0 if conversion fails"""
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
+@functools.lru_cache(maxsize=4096)
 def get_previous_trading_day(date):
     previous_date = date - timedelta(days=1)
-    while not is_workday(previous_date) or is_holiday(previous_date):
+    # 周末休市，先按星期判断再查询节假日
+    while previous_date.weekday() >= 5 or not is_workday(previous_date) or is_holiday(previous_date):
         previous_date -= timedelta(days=1)
     return previous_date
-def analyze_limit_up_reason(df, date):
-    # 提取连续涨停天数列和涨停原因类别列
-    reason_col = f'涨停原因类别[{date.strftime("%Y%m%d")}]'
-    # 确保涨停原因类别列存在
+def analyze_limit_up_reason(df):
+    # 提取涨停原因类别列
+    reason_col = '涨停原因类别'
+    # 缺少涨停原因类别列时全部归为'未知'，直接返回结果而不修改传入的 DataFrame
     if reason_col not in df.columns:
-        df[reason_col] = '未知'
-    # 按'+'分割涨停原因并展开
-    reasons = df[reason_col].str.split('+').explode().reset_index(drop=True)
-    concept_counts = reasons.value_counts().reset_index()
-    # 过滤掉出现次数小于2的项
-    concept_counts.columns = ['概念', '出现次数']
+        if df.empty:
+            return pd.DataFrame({'概念': [], '出现次数': []})
+        return pd.DataFrame({'概念': ['未知'], '出现次数': [len(df)]})
+    # 按'+'分割涨停原因并统计各概念出现次数
+    tags = df[reason_col].dropna().str.split('+')
+    counter = Counter(chain.from_iterable(tags))
+    concept_counts = pd.DataFrame(counter.most_common(), columns=['概念', '出现次数'])
+    # 保留出现次数位于前5的概念（含并列）
     max_count = top_k_elements(concept_counts['出现次数'], 5)
     concept_counts = concept_counts[concept_counts['出现次数'] >= max_count]
     return concept_counts
 
 
+# 涨停列表需要的列及其显示名称
+LIMIT_UP_RENAME_MAP = {
+    '股票代码': '代码',
+    '股票简称': '名称',
+    '最新价': '现价',
+    '最终涨停时间': '涨停时间',
+    '涨停开板次数': '炸板次数',
+    '连续涨停天数': '连板数',
+    '涨停类型': '涨停类型',
+    '涨停原因类别': '涨停原因'
+}
+LIMIT_UP_COLUMNS = list(LIMIT_UP_RENAME_MAP)
+
+
+def strip_date_suffix(df, date):
+    """去掉列名中的 [YYYYMMDD] 日期后缀，使下游按固定列名访问"""
+    suffix = f"[{date:%Y%m%d}]"
+    alias_map = {
+        col: col[:-len(suffix)]
+        for col in df.columns
+        if isinstance(col, str) and col.endswith(suffix) and col[:-len(suffix)] not in df.columns
+    }
+    return df.rename(columns=alias_map, copy=False)
+
+
 # Page config
 st.set_page_config(page_title="涨停复盘", page_icon="📈", layout="wide")
 
+# 历史交易日数据不会变化，缓存到磁盘以跳过重复的网络请求
+CACHE_DIR = Path(".cache/wencai")
+
+def load_cached_market_data(date):
+    """读取磁盘缓存的历史涨停数据，不存在时返回 None"""
+    path = CACHE_DIR / f"{date:%Y%m%d}.parquet"
+    if not path.exists():
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+def save_cached_market_data(date, df):
+    """将 pywencai 返回的原始数据写入磁盘缓存，写入失败时忽略"""
+    path = CACHE_DIR / f"{date:%Y%m%d}.parquet"
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(path)
+    except Exception:
+        path.unlink(missing_ok=True)
+
+def prepare_market_data(limit_up_df, date):
+    """处理 pywencai 返回的原始涨停数据，网络与磁盘缓存的数据都经过此处"""
+    limit_up_df = strip_date_suffix(limit_up_df, date)
+    # 天数、次数类字段统一转换为整数，下游比较与分组无需再逐行转换
+    for col in ('连续涨停天数', '涨停开板次数'):
+        if col in limit_up_df.columns:
+            limit_up_df[col] = pd.to_numeric(limit_up_df[col], errors='coerce').astype('Int64')
+    # 转换为 Arrow 类型，加速后续的字符串处理与分组
+    return limit_up_df.convert_dtypes(dtype_backend='pyarrow')
+
 # Helper functions
 @st.cache_data(ttl=300)
 def get_market_data(date):
     """获取指定日期的涨停数据"""
+    # 仅当日数据可能变化，历史日期优先读取磁盘缓存
+    is_history = date < datetime.now(ZoneInfo('Asia/Shanghai')).date()
+    limit_up_df = load_cached_market_data(date) if is_history else None
     try:
-        limit_up_query = f"{date}涨停，非ST，上市时间大于1个月，炸板次数，连续涨停天数排序"
-        limit_up_df = pywencai.get(query=limit_up_query, sort_key='连续涨停天数', sort_order='desc', loop=True)
-        return limit_up_df
+        if limit_up_df is None:
+            limit_up_query = f"{date}涨停，非ST，上市时间大于1个月，炸板次数，连续涨停天数排序"
+            limit_up_df = pywencai.get(query=limit_up_query, sort_key='连续涨停天数', sort_order='desc', loop=True)
+            if not isinstance(limit_up_df, pd.DataFrame):
+                return limit_up_df
+            if is_history and not limit_up_df.empty:
+                save_cached_market_data(date, limit_up_df)
+        return prepare_market_data(limit_up_df, date)
     except Exception as e:
         st.error(f"获取数据失败: {e}")
         return None
 
-def calculate_metrics(limit_up_df, date):
+def fetch_market_data_pair(selected_date, previous_date):
+    """并发获取所选日期及前一交易日的涨停数据"""
+    ctx = get_script_run_ctx()
+
+    def fetch(date):
+        # 将当前会话上下文绑定到工作线程，保证 st.error 等调用正常显示
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return get_market_data(date)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        selected_future = executor.submit(fetch, selected_date)
+        previous_future = executor.submit(fetch, previous_date)
+        return selected_future.result(), previous_future.result()
+
+def get_pie_figure(values, labels):
+    """构建概念分布饼图"""
+    return {
+        "data": [{
+            "values": values,
+            "labels": labels,
+            "type": "pie",
+            "textinfo": "label+percent",
+            "textposition": "inside",
+            "automargin": True,
+            "textfont": {
+                "size": 13,
+                "weight": "bold"
+            },
+            "marker": {
+                "colors": None,
+                "line": {"color": "white", "width": 2}
+            },
+        }],
+        "layout": {
+            "height": 300,
+            "showlegend": False,
+            "margin": {"t": 0, "l": 0, "r": 0, "b": 0},
+            "paper_bgcolor": "rgba(0,0,0,0)",
+            "plot_bgcolor": "rgba(0,0,0,0)",
+        }
+    }
+
+def calculate_metrics(limit_up_df):
     """计算市场指标"""
     if limit_up_df is None:
         return {}
-    date_str = date.strftime("%Y%m%d")
     try:
+        multi_count = int((limit_up_df['连续涨停天数'] > 1).sum())
         metrics = {
             "涨停数量": len(limit_up_df),
-        "连板率": round(
-            len(limit_up_df[limit_up_df[f'连续涨停天数[{date_str}]'].apply(safe_float) > 1]) / len(limit_up_df) * 100,
-                2) if len(limit_up_df) > 0 else 0,
+            "连板率": round(multi_count / len(limit_up_df) * 100, 2) if len(limit_up_df) > 0 else 0,
         }
         return metrics
     except Exception as e:
@@ -106,6 +186,124 @@ def calculate_metrics(limit_up_df, date):
         return None
     
 
+# 数据展示部分作为 fragment，筛选等交互只重新运行该部分
+@st.fragment
+def render_market_review(selected_date):
+    # 获取数据
+    previous_date = get_previous_trading_day(selected_date)
+    limit_up_df, previous_df = fetch_market_data_pair(selected_date, previous_date)
+
+    if limit_up_df is not None:
+        # 计算指标
+        metrics = calculate_metrics(limit_up_df)
+        if metrics is None:
+            return
+        chart_data = analyze_limit_up_reason(limit_up_df)
+        if not chart_data.empty:
+            st.markdown("---")
+            # 显示主要指标
+            selected_total = len(limit_up_df)
+            previous_total = len(previous_df)
+            change = selected_total - previous_total
+
+            # 创建两列布局：左侧饼图，右侧指标
+            left_col, right_col = st.columns([1, 1])
+            
+            # 左侧列显示饼图
+            with left_col:
+                fig = get_pie_figure(chart_data['出现次数'].tolist(), chart_data['概念'].tolist())
+                st.plotly_chart(fig, use_container_width=True)
+            
+            # 右侧列分为上下两行显示指标，添加垂直间距实现居中效果
+            with right_col:
+                # 添加上方空白
+                st.markdown("<br><br>", unsafe_allow_html=True)
+                
+                # 上行显示两个指标
+                col2, col3 = st.columns(2)
+                with col2:
+                    st.metric("今日涨停数量", metrics["涨停数量"])
+                with col3:
+                    st.metric("前一交易日涨停数", previous_total)
+                
+                # 添加行间距
+                st.markdown("<br>", unsafe_allow_html=True)
+                
+                # 下行显示两个指标
+                col4, col5 = st.columns(2)
+                with col4:
+                    st.metric("变化", change, f"{change:+d}", delta_color="inverse")
+                with col5:
+                    st.metric("连板率", f"{metrics['连板率']}%")
+
+        # 涨停股票列表
+        st.markdown("---")
+        
+        # 处理数据并按连板天数分组
+        df_processed = limit_up_df.reindex(columns=LIMIT_UP_COLUMNS, copy=False).rename(
+            columns=LIMIT_UP_RENAME_MAP, copy=False
+        )
+        
+        # 连板数在获取时已转换为整数，按降序排列，缺失值排在最后
+        df_processed = df_processed.sort_values('连板数', ascending=False, kind='stable')
+        # 连板数只有少量取值，直接统计各取值的数量并按降序排列，无需构建分组
+        # 缺失连板数的行不单独成组，只在"全部"中显示
+        group_sizes = df_processed['连板数'].value_counts().sort_index(ascending=False)
+
+        def format_group(days):
+            # 根据连板天数显示不同的文本
+            if days == "全部":
+                return f"全部 ({len(df_processed)})"
+            display_text = "首板" if days == 1 else f"{days}连板"
+            return f"{display_text} ({group_sizes[days]})"
+
+        # 用一个筛选框加单张表格代替逐组渲染多张表格
+        selected_days = st.selectbox(
+            label="连板筛选",
+            options=["全部", *(int(days) for days in group_sizes.index)],
+            format_func=format_group,
+        )
+        if selected_days == "全部":
+            display_df = df_processed
+        else:
+            display_df = df_processed.loc[df_processed['连板数'].eq(selected_days).fillna(False)]
+        st.dataframe(
+            display_df,
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                "现价": st.column_config.NumberColumn(
+                    "现价",
+                    help="最新价；历史日期读取磁盘缓存时为首次获取数据时的价格"
+                ),
+                "连板数": st.column_config.NumberColumn(
+                    "连板数",
+                    format="%d"
+                ),
+                "涨停原因": st.column_config.TextColumn(
+                    "涨停原因",
+                    width="large",
+                    help="涨停原因类别"
+                )
+            }
+        )
+
+        # 下载数据按钮
+        # col1, col2 = st.columns(2)
+        # with col1:
+        #     # 直接写入字节缓冲区，避免先生成完整字符串再编码
+        #     import io
+        #     csv_buffer = io.BytesIO()
+        #     limit_up_df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+        #     st.download_button(
+        #         label="下载涨停股票数据",
+        #         data=csv_buffer.getvalue(),
+        #         file_name=f"limit_up_stocks_{selected_date}.csv",
+        #         mime="text/csv",
+        #     )
+    else:
+        st.warning(f"未找到 {selected_date} 的市场数据")
+
 # Main app
 def app():
     st.title("涨停复盘")
@@ -131,135 +329,7 @@ def app():
         return
 
     if selected_date:
-        # 获取数据
-        previous_date = get_previous_trading_day(selected_date)
-        limit_up_df = get_market_data(selected_date)
-        previous_df = get_market_data(previous_date)
-
-        if limit_up_df is not None:
-            # 计算指标
-            metrics = calculate_metrics(limit_up_df, selected_date)
-            if metrics is None:
-                return
-            chart_data = analyze_limit_up_reason(limit_up_df, selected_date)
-            if not chart_data.empty:
-                st.markdown("---")
-                # 显示主要指标
-                selected_total = len(limit_up_df)
-                previous_total = len(previous_df)
-                change = selected_total - previous_total
-
-                # 创建两列布局：左侧饼图，右侧指标
-                left_col, right_col = st.columns([1, 1])
-                
-                # 左侧列显示饼图
-                with left_col:
-                    fig = {
-                        "data": [{
-                            "values": chart_data['出现次数'].tolist(),
-                            "labels": chart_data['概念'].tolist(),
-                            "type": "pie",
-                            "textinfo": "label+percent",
-                            "textposition": "inside",
-                            "automargin": True,
-                            "textfont": {
-                                "size": 13,
-                                "weight": "bold"
-                            },
-                            "marker": {
-                                "colors": None,
-                                "line": {"color": "white", "width": 2}
-                            },
-                        }],
-                        "layout": {
-                            "height": 300,
-                            "showlegend": False,
-                            "margin": {"t": 0, "l": 0, "r": 0, "b": 0},
-                            "paper_bgcolor": "rgba(0,0,0,0)",
-                            "plot_bgcolor": "rgba(0,0,0,0)",
-                        }
-                    }
-                    st.plotly_chart(fig, use_container_width=True)
-                
-                # 右侧列分为上下两行显示指标，添加垂直间距实现居中效果
-                with right_col:
-                    # 添加上方空白
-                    st.markdown("<br><br>", unsafe_allow_html=True)
-                    
-                    # 上行显示两个指标
-                    col2, col3 = st.columns(2)
-                    with col2:
-                        st.metric("今日涨停数量", metrics["涨停数量"])
-                    with col3:
-                        st.metric("前一交易日涨停数", previous_total)
-                    
-                    # 添加行间距
-                    st.markdown("<br>", unsafe_allow_html=True)
-                    
-                    # 下行显示两个指标
-                    col4, col5 = st.columns(2)
-                    with col4:
-                        st.metric("变化", change, f"{change:+d}", delta_color="inverse")
-                    with col5:
-                        st.metric("连板率", f"{metrics['连板率']}%")
-
-            # 涨停股票列表
-            st.markdown("---")
-            date_str = selected_date.strftime("%Y%m%d")
-            
-            # 处理数据并按连板天数分组
-            df_processed = limit_up_df[['股票代码','股票简称','最新价',f'最终涨停时间[{date_str}]',
-                                      f'涨停开板次数[{date_str}]', f'连续涨停天数[{date_str}]', 
-                                      f'涨停类型[{date_str}]',f'涨停原因类别[{date_str}]']].rename(
-                columns={
-                    '股票代码': '代码',
-                    '股票简称': '名称',
-                    '最新价': '现价',
-                    f'最终涨停时间[{date_str}]': '涨停时间',
-                    f'涨停开板次数[{date_str}]': '炸板次数',
-                    f'连续涨停天数[{date_str}]': '连板数',
-                    f'涨停类型[{date_str}]': '涨停类型',
-                    f'涨停原因类别[{date_str}]': '涨停原因'
-                }
-            )
-            
-            # 按连板数分组并排序
-            grouped = df_processed.groupby('连板数', sort=True)
-            
-            # 按组显示数据
-            for days, group in sorted(grouped, key=lambda x: float(x[0]) if isinstance(x[0], str) else x[0], reverse=True):
-                # 根据连板天数显示不同的文本
-                display_text = "首板" if days == 1 else f"{days}连板"
-                group_count = len(group)
-                display_count = f" ({group_count})" if group_count >= 10 else ""
-                st.markdown(f"### {display_text}{display_count}")
-                # 在显示之前删除'连板数'列
-                display_group = group.drop(columns=['连板数'])
-                st.dataframe(
-                    display_group,
-                    hide_index=True,
-                    use_container_width=True,
-                    column_config={
-                        "涨停原因": st.column_config.TextColumn(
-                            "涨停原因",
-                            width="large",
-                            help="涨停原因类别"
-                        )
-                    }
-                )
-
-            # 下载数据按钮
-            # col1, col2 = st.columns(2)
-            # with col1:
-            #     csv_limit_up = limit_up_df.to_csv(index=False)
-            #     st.download_button(
-            #         label="下载涨停股票数据",
-            #         data=csv_limit_up,
-            #         file_name=f"limit_up_stocks_{selected_date}.csv",
-            #         mime="text/csv",
-            #     )
-        else:
-            st.warning(f"未找到 {selected_date} 的市场数据")
+        render_market_review(selected_date)
 
 if __name__ =="__main__":
     app()